@@ -19,9 +19,9 @@ other PyTorch datasets more directly, including also HuggingFace datasets.
 """
 
 from __future__ import annotations
-from typing import Dict, Iterable, List, Union
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
 import sys
-from copy import deepcopy
+from operator import itemgetter
 
 import numpy as np
 import torch
@@ -29,7 +29,7 @@ import torch.utils.data
 
 from returnn.util.basic import NumbersDict
 
-InputType = Union[np.ndarray, int, str, float, bool]
+InputType = Union[np.ndarray, torch.Tensor, int, str, float, bool]
 OutputType = Union[torch.Tensor, int, str, float, bool]
 
 
@@ -51,38 +51,183 @@ def create_tensor(value: InputType) -> OutputType:
     return torch.tensor(value)
 
 
-def collate_batch(batch: List[Dict[str, InputType]], device: str = "cpu") -> Dict[str, OutputType]:
+# For smaller buffers, np.zeros is cheaper than zeroing the padding separately.
+_MinBytesForPartialZeroPadding = 4 * 1024 * 1024
+
+
+def _pad_into_buffer(values: Sequence[np.ndarray], max_shape: Tuple[int, ...], dtype: np.dtype) -> np.ndarray:
+    """
+    Pads all values into a single preallocated buffer instead of going through pad_sequence,
+    which allocates and copies per tensor.
+
+    We do not reuse the buffer across batches:
+    the collated batch is still in use (in the DataLoader queue, or moved to shared memory)
+    while the next batch is collated.
+    For large buffers, we avoid writing the whole buffer twice though, and only zero the padding.
+
+    :param values: arrays with the same number of axes
+    :param max_shape: max over the shapes of values
+    :param dtype: of the result
+    :return: padded values, shape [len(values)] + max_shape
     """
-    Use with `functools.partial` to set the device!
+    buffer_shape = (len(values),) + max_shape
+    zero_padding_only = np.prod(buffer_shape) * np.dtype(dtype).itemsize >= _MinBytesForPartialZeroPadding
+    padded = (np.empty if zero_padding_only else np.zeros)(buffer_shape, dtype=dtype)
+    for i, v in enumerate(values):
+        padded[(i,) + tuple(slice(0, n) for n in v.shape)] = v
+        if zero_padding_only:
+            # The padding of this sample, split into disjoint parts, one per axis.
+            for axis, n in enumerate(v.shape):
+                if n < max_shape[axis]:
+                    padded[(i,) + tuple(slice(0, m) for m in v.shape[:axis]) + (slice(n, None),)] = 0
+    return padded
+
+
+def collate_batch(
+    batch: List[Dict[str, InputType]],
+    device: str = "cpu",
+    dtype_map: Optional[Dict[str, torch.dtype]] = None,
+) -> Dict[str, OutputType]:
+    """
+    Use with `functools.partial` to set the device and dtype_map!
+
+    When this runs in a DataLoader worker, better keep the default device "cpu"
+    and use :func:`batch_to_device` in the main process instead,
+    together with ``pin_memory=True`` in the DataLoader.
 
     :param batch: the batch as list to collate into single Tensors
     :param device: the target device to move the Tensor to
+    :param dtype_map: data_key -> dtype to cast floating point data to, before moving it to the device.
+        E.g. when the model runs with AMP in bfloat16 anyway, this halves the size of the transfer.
     """
     assert isinstance(batch, list)
     assert batch, "batch is empty?"
     assert isinstance(batch[0], dict)
     data_keys = list(batch[0].keys())
+    # Transpose into data_key -> values of all samples in one pass, with the dict lookups done by itemgetter.
+    if len(data_keys) == 1:
+        values_per_key = [[sample[data_keys[0]] for sample in batch]]
+    else:
+        values_per_key = zip(*map(itemgetter(*data_keys), batch))
 
     res = {}
-    for key in data_keys:
-        ls = [create_tensor(sample[key]) for sample in batch]
-        if not isinstance(ls[0], torch.Tensor):
-            # no padding for non-Tensor types
-            res[key] = ls
-            continue
-        num_axis = len(ls[0].size())
-        if num_axis > 0:
-            padded = torch.nn.utils.rnn.pad_sequence(ls, batch_first=True, padding_value=0)
-            for i in range(num_axis):
-                res["%s:size%i" % (key, i + 1)] = torch.tensor([v.shape[i] for v in ls]).to(device)
+    for key, ls in zip(data_keys, values_per_key):
+        if isinstance(ls[0], np.ndarray):
+            num_axis = ls[0].ndim
+            shapes = np.array([v.shape for v in ls], dtype=np.int64).reshape(len(ls), num_axis)
+            # The only supported PyTorch dtypes are:
+            # float64, float32, float16, complex64, complex128, int64, int32, int16, int8, uint8, and bool.
+            dtype = np.int64 if ls[0].dtype == np.uint32 else ls[0].dtype
+            padded = _pad_into_buffer(ls, tuple(shapes.max(axis=0, initial=0)), dtype=dtype)
+            padded = torch.from_numpy(padded)
+        elif isinstance(ls[0], torch.Tensor):
+            # E.g. from other PyTorch datasets.
+            # Keep them as tensors, as NumPy does not support all dtypes (e.g. bfloat16), and they might be on GPU.
+            num_axis = ls[0].dim()
+            shapes = np.array([v.shape for v in ls], dtype=np.int64).reshape(len(ls), num_axis)
+            max_shape = tuple(shapes.max(axis=0, initial=0).tolist())
+            padded = torch.zeros((len(ls),) + max_shape, dtype=ls[0].dtype, device=ls[0].device)
+            for i, v in enumerate(ls):
+                padded[(i,) + tuple(slice(0, n) for n in v.shape)] = v
         else:
-            padded = torch.stack(ls)
+            # no padding for non-array types
+            res[key] = list(ls)
+            continue
+        if dtype_map and key in dtype_map and padded.is_floating_point():
+            padded = padded.to(dtype_map[key])
         res[key] = padded.to(device)
-        res["%s:size0" % key] = torch.tensor(len(ls)).to(device)
+        # One allocation for all axes, the sizes per axis are views on it.
+        sizes = torch.from_numpy(np.ascontiguousarray(shapes.T)).to(device)
+        for i in range(num_axis):
+            res["%s:size%i" % (key, i + 1)] = sizes[i]
+        res["%s:size0" % key] = torch.tensor(len(ls), dtype=torch.int64, device=device)
+
+    return res
 
+
+def batch_to_device(batch: Dict[str, OutputType], device: str) -> Dict[str, OutputType]:
+    """
+    Moves the collated batch (see :func:`collate_batch`) to the device.
+    The copies are non-blocking, so if the batch is in pinned memory
+    (e.g. via ``DataLoader(..., pin_memory=True)``), the host-to-device transfer overlaps with other work.
+
+    For a real host-to-device copy, the sizes ("<data_key>:size<axis>"), which are many small tensors,
+    are concatenated and moved to the device with a single copy.
+
+    :param batch: data_key -> tensor, or other values which are returned as is
+    :param device: target device
+    """
+    concat_sizes = torch.device(device or "cpu").type != "cpu"
+    res = {}
+    sizes = []  # (key, tensor)
+    for key, value in batch.items():
+        if isinstance(value, torch.Tensor):
+            if concat_sizes and value.dtype == torch.int64 and _is_size_key(key, batch):
+                sizes.append((key, value))
+            else:
+                value = value.to(device, non_blocking=True)
+        res[key] = value
+    if sizes:
+        sizes_flat = torch.cat([value.reshape(-1) for _, value in sizes])
+        if sizes[0][1].is_pinned():  # keep it pinned, e.g. from DataLoader(..., pin_memory=True)
+            sizes_flat = sizes_flat.pin_memory()
+        sizes_flat = sizes_flat.to(device, non_blocking=True)
+        offset = 0
+        for key, value in sizes:
+            res[key] = sizes_flat[offset : offset + value.numel()].view(value.shape)
+            offset += value.numel()
     return res
 
 
+def _is_size_key(key: str, batch: Dict[str, OutputType]) -> bool:
+    """
+    :param key: in batch
+    :param batch: see :func:`collate_batch`
+    :return: whether key is "<data_key>:size<axis>" for some tensor data_key in the batch
+    """
+    data_key, sep, axis = key.rpartition(":size")
+    return bool(sep) and axis.isdigit() and isinstance(batch.get(data_key), torch.Tensor)
+
+
+# sliding_window_view has a constant overhead of a few dozen microseconds,
+# so slicing is faster unless there are many chunks.
+_MinNumChunksForSlidingWindowView = 256
+
+
+def _split_into_chunks(data: np.ndarray, chunk_size: int, chunk_step: int) -> List[np.ndarray]:
+    """
+    Splits data along the first axis into chunks of size chunk_size, starting every chunk_step frames.
+    The last chunks can be shorter.
+
+    :param data: sequence to split
+    :param chunk_size:
+    :param chunk_step:
+    :return: chunks, as views on data
+    """
+    length = len(data)
+    if length <= chunk_size and length <= chunk_step:
+        # Common for short sequences: a single chunk covering everything, no need to slice.
+        return [data] if length > 0 else []
+    # All full-size chunks come from one strided view, its rows are the chunks.
+    if chunk_size == chunk_step:
+        num_full_chunks = length // chunk_size
+        full_chunks = data[: num_full_chunks * chunk_size].reshape((num_full_chunks, chunk_size) + data.shape[1:])
+    elif length >= chunk_size and (length - chunk_size) // chunk_step + 1 >= _MinNumChunksForSlidingWindowView:
+        num_full_chunks = (length - chunk_size) // chunk_step + 1
+        windows = np.lib.stride_tricks.sliding_window_view(data, chunk_size, axis=0)[::chunk_step]
+        full_chunks = np.moveaxis(windows, -1, 1)  # window axis is last, move it back to the time axis
+    else:
+        num_full_chunks = 0
+        full_chunks = ()
+    chunks = list(full_chunks)
+    # Remaining chunks at the end which are shorter than chunk_size.
+    chunks.extend(
+        data[start_index : start_index + chunk_size]
+        for start_index in range(num_full_chunks * chunk_step, length, chunk_step)
+    )
+    return chunks
+
+
 class ChunkingIterDataPipe(torch.utils.data.IterDataPipe):
     """
     Splits each sequence in the given dataset into chunks according to the 'chunking' config option.
@@ -107,34 +252,36 @@ class ChunkingIterDataPipe(torch.utils.data.IterDataPipe):
         # noinspection PyProtectedMember
         self._chunk_size, self._chunk_step, custom_chunk_func = self._parse_chunking(chunking)
         assert not custom_chunk_func, f"Custom chunking function not supported, {chunking!r}"
+        # Resolved once as plain ints, for the lookups in __iter__.
+        self._chunk_size_and_step = {
+            data_key: (int(self._chunk_size[data_key]), int(self._chunk_step[data_key]))
+            for data_key in self._chunk_size.keys()
+        }
 
     def __iter__(self) -> Iterable[List[Dict[str, InputType]]]:
         """
         :return: generator providing chunks in the form of a dict data_key -> data chunk
         """
-        chunking_data_keys = list(self._chunk_size.keys())
+        chunk_size_and_step = self._chunk_size_and_step
 
         for data_dict in self._dataset:
 
-            if not chunking_data_keys:
+            if not chunk_size_and_step:
                 chunking_data_keys = list(data_dict.keys())  # use all if not configured separately
                 # TODO: for now explicit removal of seq_tag and seq_idx, we might want
                 # to have only explicit chunking keys instead
                 chunking_data_keys.remove("seq_tag")
                 chunking_data_keys.remove("seq_idx")
                 assert chunking_data_keys, "Dataset produced sequence without any data."
+                default_size_and_step = (int(self._chunk_size.value), int(self._chunk_step.value))
+                chunk_size_and_step = {data_key: default_size_and_step for data_key in chunking_data_keys}
 
             data_chunks = {}
             num_chunks = None
 
-            for data_key in chunking_data_keys:
-                chunk_size = self._chunk_size[data_key]
-                chunk_step = self._chunk_step[data_key]
-
+            for data_key, (chunk_size, chunk_step) in chunk_size_and_step.items():
                 data = data_dict[data_key]
-                chunks = [
-                    data[start_index : start_index + chunk_size] for start_index in range(0, len(data), chunk_step)
-                ]
+                chunks = _split_into_chunks(data, chunk_size, chunk_step)
 
                 if num_chunks is None:
                     num_chunks = len(chunks)
@@ -146,17 +293,16 @@ class ChunkingIterDataPipe(torch.utils.data.IterDataPipe):
                 data_chunks[data_key] = chunks
 
             assert num_chunks, "Bug: no chunk produced from current sequence."
+
+            # If chunking is configured using a dict,
+            # i.e. with explicit data keys, there might be remaining data keys
+            # for which we yield the full sequence in each chunk.
+            # Downstream (batching, collate_batch) only reads them, so all chunks share the same objects.
+            non_chunked_data = {data_key: data for data_key, data in data_dict.items() if data_key not in data_chunks}
+
             for chunk_index in range(num_chunks):
                 chunk_data = {data_key: data_chunks[data_key][chunk_index] for data_key in data_chunks.keys()}
-
-                # If chunking is configured using a dict,
-                # i.e. with explicit data keys, there might be remaining data keys
-                # for which we yield the full sequence in each chunk.
-                non_chunked_data = {
-                    data_key: data for data_key, data in data_dict.items() if data_key not in chunk_data
-                }
-                if non_chunked_data:
-                    chunk_data.update(deepcopy(non_chunked_data))
+                chunk_data.update(non_chunked_data)
 
                 yield chunk_data
 
@@ -224,6 +370,10 @@ class BatchingIterDataPipe(torch.utils.data.IterDataPipe):
         self._max_batch_size = NumbersDict(sys.maxsize if batch_size is None else batch_size)
         self._max_seqs = sys.maxsize if (max_seqs is None or max_seqs == -1) else max_seqs
         self._drop_last = drop_last
+        # Resolved once for __iter__: data_key -> limit, and the limit for all other data keys (None: unlimited).
+        # Data keys without a limit are not tracked there at all.
+        self._max_batch_size_per_key = dict(self._max_batch_size.dict)
+        self._max_batch_size_default = None if batch_size is None else self._max_batch_size.value
 
         assert self._max_batch_size.min_value() > 0
         assert self._max_seqs > 0
@@ -233,28 +383,42 @@ class BatchingIterDataPipe(torch.utils.data.IterDataPipe):
         :return: generator providing batches in the form of lists of sequences, where each sequence is a dict
           data_key -> data_array.
         """
+        # Plain dicts instead of NumbersDict, as this runs for every single sequence.
+        max_batch_size_per_key = self._max_batch_size_per_key
+        max_batch_size_default = self._max_batch_size_default
+
         current_batch = []
-        current_max_sequence_lengths = NumbersDict(0)  # data_key -> length of longest sequence in current batch
+        # data_key -> length of longest sequence in current batch, only for data keys with a limit
+        current_max_sequence_lengths = {}
 
         for data_dict in self._dataset:
             if len(current_batch) == self._max_seqs:
                 yield current_batch
                 current_batch = []
-                current_max_sequence_lengths = NumbersDict(0)
-
-            # TODO: This assumes all data has time as first dimension. Currently we can't know better..
-            # Scalars are treated as length 1
-            sequence_lengths = NumbersDict(
-                {
-                    data_key: (data.shape[0] if isinstance(data, np.ndarray) and len(data.shape) > 0 else 1)
-                    for data_key, data in data_dict.items()
-                }
-            )
-
-            max_sequence_lengths_if_included = NumbersDict.max([current_max_sequence_lengths, sequence_lengths])
-            batch_size_if_included = max_sequence_lengths_if_included * (len(current_batch) + 1)  # including padding
-
-            if current_batch and batch_size_if_included.any_compare(self._max_batch_size, (lambda a, b: a > b)):
+                current_max_sequence_lengths = {}
+
+            sequence_lengths = {}
+            for data_key, data in data_dict.items():
+                if max_batch_size_per_key.get(data_key, max_batch_size_default) is None:
+                    continue
+                # TODO: This assumes all data has time as first dimension. Currently we can't know better..
+                # Scalars are treated as length 1
+                sequence_lengths[data_key] = data.shape[0] if isinstance(data, np.ndarray) and data.ndim > 0 else 1
+
+            max_sequence_lengths_if_included = current_max_sequence_lengths.copy()
+            for data_key, sequence_length in sequence_lengths.items():
+                if sequence_length > max_sequence_lengths_if_included.get(data_key, 0):
+                    max_sequence_lengths_if_included[data_key] = sequence_length
+
+            num_seqs_if_included = len(current_batch) + 1
+            batch_size_exceeded = False
+            for data_key, max_sequence_length in max_sequence_lengths_if_included.items():
+                limit = max_batch_size_per_key.get(data_key, max_batch_size_default)
+                if max_sequence_length * num_seqs_if_included > limit:  # including padding
+                    batch_size_exceeded = True
+                    break
+
+            if current_batch and batch_size_exceeded:
                 yield current_batch
                 current_batch = [data_dict]
                 current_max_sequence_lengths = sequence_lengths
@@ -4,7 +4,7 @@ Main engine for PyTorch
 
 from __future__ import annotations
 from functools import partial
-from typing import Optional, Callable, Dict, Tuple
+from typing import Optional, Callable, Dict, List, Tuple
 from contextlib import nullcontext
 
 import os
@@ -68,6 +68,7 @@ class Engine(EngineBase):
         print(f"Using device {self._device}", file=log.v3)
 
         self._amp_dtype = None  # type: Optional[torch.dtype]
+        self._amp_cast_data_keys = []  # type: List[str]
         self._grad_scaler = None  # type: Optional[amp.GradScaler]
 
     def init_train(
@@ -81,6 +82,16 @@ class Engine(EngineBase):
         """
         super().init_train(train_data=train_data, dev_data=dev_data)
 
+        amp_options = self.config.typed_value("torch_amp_options")
+        if amp_options is not None:
+            assert isinstance(amp_options, dict)
+            amp_dtype_str = amp_options.get("dtype")
+            assert amp_dtype_str in ["float16", "bfloat16"]
+            self._amp_dtype = getattr(torch, amp_dtype_str)
+            self._grad_scaler = amp.GradScaler()
+            # Floating point data of these keys is already cast to the AMP dtype in the data loader.
+            self._amp_cast_data_keys = list(amp_options.get("cast_data_keys", []))
+
         self._train_dataloader = self._create_data_loader(self.train_dataset)
         for dataset_name, dataset in self.eval_datasets.items():
             self._eval_dataloaders[dataset_name] = self._create_data_loader(dataset)
@@ -99,14 +110,6 @@ class Engine(EngineBase):
         self._train_step_func = self.config.typed_value("train_step")
         assert self._train_step_func, "train_step not defined"
 
-        amp_options = self.config.typed_value("torch_amp_options")
-        if amp_options is not None:
-            assert isinstance(amp_options, dict)
-            amp_dtype_str = amp_options.get("dtype")
-            assert amp_dtype_str in ["float16", "bfloat16"]
-            self._amp_dtype = getattr(torch, amp_dtype_str)
-            self._grad_scaler = amp.GradScaler()
-
     def init_forward(
         self,
         forward_data: Optional[Dataset] = None,
@@ -174,7 +177,7 @@ class Engine(EngineBase):
             run_ctx = get_run_ctx()
             run_ctx.init_step()
 
-            total_loss, ctx_losses_dict = self.run_train_step(data, run_ctx)
+            total_loss, ctx_losses_dict = self.run_train_step(self._data_to_device(data), run_ctx)
 
             losses_dict = NumbersDict(
                 {name: float(loss.loss.detach().cpu().numpy()) for name, loss in ctx_losses_dict.items()}
@@ -234,7 +237,7 @@ class Engine(EngineBase):
                     run_ctx = get_run_ctx()
                     run_ctx.init_step()
 
-                    total_loss, ctx_losses_dict = self.run_eval_step(data, run_ctx)
+                    total_loss, ctx_losses_dict = self.run_eval_step(self._data_to_device(data), run_ctx)
 
                     losses_dict = NumbersDict(
                         {name: float(loss.loss.detach().cpu().numpy()) for name, loss in ctx_losses_dict.items()}
@@ -295,7 +298,7 @@ class Engine(EngineBase):
                 run_ctx = get_run_ctx()
                 run_ctx.init_step()
 
-                self.run_forward_step(data, run_ctx)
+                self.run_forward_step(self._data_to_device(data), run_ctx)
 
                 self.print_step_info(
                     f"forward epoch {self.epoch}",
@@ -337,11 +340,29 @@ class Engine(EngineBase):
         batches_dataset = data_pipeline.BatchingIterDataPipe(
             wrapped_dataset, batch_size=batch_size, max_seqs=max_seqs, drop_last=batch_drop_last
         )
-        batches_dataset = dp.iter.Collator(
-            batches_dataset, collate_fn=partial(data_pipeline.collate_batch, device=self._device)
+        # Collate on CPU in the worker, the main process moves the (pinned) batch to the device, see _data_to_device.
+        collate_fn = data_pipeline.collate_batch
+        if self._amp_cast_data_keys:
+            collate_fn = partial(collate_fn, dtype_map={key: self._amp_dtype for key in self._amp_cast_data_keys})
+        batches_dataset = dp.iter.Collator(batches_dataset, collate_fn=collate_fn)
+
+        return DataLoader(
+            dataset=batches_dataset,
+            batch_size=None,
+            num_workers=1,
+            multiprocessing_context="spawn",
+            # Note: this keeps one worker (with its own dataset copy) alive per data loader, i.e. also per eval dataset.
+            persistent_workers=True,
+            # Also for e.g. "cuda:0", otherwise the non-blocking copies in _data_to_device would be synchronous.
+            pin_memory=torch.device(self._device or "cpu").type == "cuda",
         )
 
-        return DataLoader(dataset=batches_dataset, batch_size=None, num_workers=1, multiprocessing_context="spawn")
+    def _data_to_device(self, data: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """
+        :param data: batch from one of our data loaders
+        :return: batch on self._device
+        """
+        return data_pipeline.batch_to_device(data, self._device)
 
     def run_train_step(self, data: dict[str, torch.Tensor], run_ctx: RunCtx) -> Tuple[Tensor, Dict[str, Loss]]:
         """
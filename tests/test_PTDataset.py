@@ -85,6 +85,106 @@ def test_HDFDataset():
     assert c == n
 
 
+def test_collate_batch():
+    import numpy
+
+    batch = [
+        {"data": numpy.ones((3, 2), dtype="float32"), "classes": numpy.array([1, 2], dtype="uint32"), "seq_idx": 0},
+        {"data": numpy.ones((5, 2), dtype="float32"), "classes": numpy.array([3], dtype="uint32"), "seq_idx": 1},
+    ]
+    res = data_pipeline.collate_batch(batch)
+    assert res["data"].shape == (2, 5, 2) and res["data"].dtype == torch.float32
+    assert res["data"][0, 3:].abs().sum() == 0 and res["data"][1].sum() == 10
+    assert res["data:size1"].tolist() == [3, 5] and res["data:size2"].tolist() == [2, 2]
+    assert res["data:size0"] == 2
+    assert res["classes"].dtype == torch.int64 and res["classes"].tolist() == [[1, 2], [3, 0]]
+    assert res["seq_idx"] == [0, 1]
+    res = data_pipeline.batch_to_device(res, "cpu")
+    assert res["data:size1"].tolist() == [3, 5] and res["data:size2"].tolist() == [2, 2]
+    assert res["data:size0"] == 2 and res["classes:size1"].tolist() == [2, 1]
+    assert res["data"].shape == (2, 5, 2) and res["seq_idx"] == [0, 1]
+    res = data_pipeline.batch_to_device({"x:sizes": torch.tensor([1, 2]), "x:size1": torch.tensor([3])}, "cpu")
+    assert res["x:sizes"].tolist() == [1, 2] and res["x:size1"].tolist() == [3]
+    # Any non-CPU device takes the path which concatenates the sizes, "meta" keeps only the shapes.
+    res = data_pipeline.batch_to_device(data_pipeline.collate_batch(batch), "meta")
+    assert res["data"].device.type == "meta" and res["data"].shape == (2, 5, 2)
+    assert res["data:size0"].shape == () and res["data:size1"].shape == res["classes:size1"].shape == (2,)
+
+    res = data_pipeline.collate_batch([{"data": torch.ones(2)}, {"data": torch.ones(3)}])
+    assert res["data"].tolist() == [[1.0, 1.0, 0.0], [1.0, 1.0, 1.0]]
+    assert res["data:size0"] == 2 and res["data:size1"].tolist() == [2, 3]
+    res = data_pipeline.collate_batch(
+        [{"data": torch.ones(2, dtype=torch.bfloat16)}, {"data": torch.ones(3, dtype=torch.bfloat16)}]
+    )
+    assert res["data"].dtype == torch.bfloat16 and res["data"].tolist() == [[1.0, 1.0, 0.0], [1.0, 1.0, 1.0]]
+    assert res["data:size1"].tolist() == [2, 3]
+
+    # Branch which allocates with np.empty and only zeros the padding.
+    min_bytes = data_pipeline._MinBytesForPartialZeroPadding
+    data_pipeline._MinBytesForPartialZeroPadding = 0
+    try:
+        shapes = [(2, 4, 1), (0, 3, 2), (3, 1, 2), (1, 4, 2)]
+        res = data_pipeline.collate_batch([{"data": numpy.full(shape, 7.0, dtype="float32")} for shape in shapes])
+    finally:
+        data_pipeline._MinBytesForPartialZeroPadding = min_bytes
+    padded = res["data"].numpy()
+    assert padded.shape == (4, 3, 4, 2)
+    for i, shape in enumerate(shapes):
+        mask = numpy.zeros(padded.shape[1:], dtype=bool)
+        mask[tuple(slice(0, n) for n in shape)] = True
+        assert (padded[i][mask] == 7.0).all() and (padded[i][~mask] == 0.0).all()
+
+    res = data_pipeline.collate_batch(batch, dtype_map={"data": torch.bfloat16, "classes": torch.bfloat16})
+    assert res["data"].dtype == torch.bfloat16 and res["data"][1].sum() == 10
+    assert res["classes"].dtype == torch.int64  # only floating point data is cast
+
+
+def test_chunking():
+    import numpy
+
+    seqs = [
+        {
+            "data": numpy.arange(10, dtype="float32").reshape(5, 2),
+            "classes": numpy.arange(5, dtype="int32"),
+            "seq_tag": numpy.array("seq-0"),
+            "seq_idx": numpy.array(0),
+        }
+    ]
+    chunks = list(data_pipeline.ChunkingIterDataPipe(seqs, chunking=({"data": 2}, {"data": 2})))
+    assert len(chunks) == 3
+    assert [c["data"].shape for c in chunks] == [(2, 2), (2, 2), (1, 2)]
+    assert chunks[2]["data"].tolist() == [[8.0, 9.0]]
+    for c in chunks:
+        assert c["classes"].tolist() == list(range(5)) and c["seq_tag"] == "seq-0"
+
+    chunks = list(data_pipeline.ChunkingIterDataPipe(seqs, chunking=(3, 2)))
+    assert [c["classes"].tolist() for c in chunks] == [[0, 1, 2], [2, 3, 4], [4]]
+    assert [c["data"].shape for c in chunks] == [(3, 2), (3, 2), (1, 2)]
+
+    # long enough for the strided view code paths
+    long_seq = {"data": numpy.arange(2001 * 3, dtype="float32").reshape(2001, 3), "seq_tag": "long", "seq_idx": 0}
+    for chunk_size, chunk_step in [(4, 4), (4, 2), (3, 5)]:
+        chunks = list(data_pipeline.ChunkingIterDataPipe([long_seq], chunking=(chunk_size, chunk_step)))
+        expected = [long_seq["data"][i : i + chunk_size] for i in range(0, 2001, chunk_step)]
+        assert len(chunks) == len(expected)
+        for chunk, expected_chunk in zip(chunks, expected):
+            assert chunk["data"].shape == expected_chunk.shape and (chunk["data"] == expected_chunk).all()
+
+
+def test_batching():
+    import numpy
+
+    seqs = [
+        {"data": numpy.zeros((n, 2)), "classes": numpy.zeros((2,)), "seq_idx": i} for i, n in enumerate([3, 2, 4, 1])
+    ]
+    batches = list(data_pipeline.BatchingIterDataPipe(seqs, batch_size=8))
+    assert [[s["seq_idx"] for s in b] for b in batches] == [[0, 1], [2, 3]]
+    batches = list(data_pipeline.BatchingIterDataPipe(seqs, batch_size={"classes": 4}))
+    assert [[s["seq_idx"] for s in b] for b in batches] == [[0, 1], [2, 3]]
+    batches = list(data_pipeline.BatchingIterDataPipe(seqs, batch_size=None, max_seqs=3, drop_last=True))
+    assert [[s["seq_idx"] for s in b] for b in batches] == [[0, 1, 2]]
+
+
 if __name__ == "__main__":
     better_exchook.install()
     if len(sys.argv) <= 1: